@@ -17,7 +17,8 @@ CUDA_VISIBLE_DEVICES=0 python train_script.py \
   --wd=${WD:=5e-4} \
 	--max-lr=${MLR:=1e-2} \
 	--epoch=${EPOCHS:=8} \
-	--batch-size=${BSIZE:=32}
+	--batch-size=${BSIZE:=32} \
+	--amp=${AMP:=off}
 
 
 CUDA_VISIBLE_DEVICES=0 python eval_script.py \
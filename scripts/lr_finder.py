@@ -39,6 +39,7 @@ def get_arguments():
     parser.add_argument("--wd", type=float, default=5e-4)
     parser.add_argument("--version", type=str, default='TAME',
                         choices=['TAME', 'Noskipconnection', 'NoskipNobatchnorm', 'Sigmoidinfeaturebranch'])
+    parser.add_argument("--debug", action='store_true', help='Enable autograd anomaly detection (slow)')
     return parser.parse_args()
 
 
@@ -61,13 +62,16 @@ def find_lr(args, init_value=1e-8, final_value=10., beta=0.999):
     mult = (final_value / init_value) ** (1/num)
     lr = init_value
 
-    weights = [weight for name, weight in net.attn_mech.named_parameters() if 'weight' in name]
-    biases = [bias for name, bias in net.attn_mech.named_parameters() if 'bias' in name]
-    torch.autograd.set_detect_anomaly(True)
+    weights, biases = [], []
+    for name, param in net.attn_mech.named_parameters():
+        if param.requires_grad:
+            (biases if 'bias' in name else weights).append(param)
+    if args.debug:
+        torch.autograd.set_detect_anomaly(True)
 
     optimizer = optim.SGD([{'params': weights, 'lr': lr, 'weight_decay': args.wd},
                            {'params': biases, 'lr': lr * 2}],
-                          momentum=0.9, nesterov=True)
+                          momentum=0.9, nesterov=True, foreach=True)
 
     optimizer.param_groups[0]['lr'] = lr
     optimizer.param_groups[1]['lr'] = 2 * lr
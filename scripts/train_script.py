@@ -1,24 +1,31 @@
 import argparse
+import contextlib
 import datetime
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import torch
+import torch.distributed as dist
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
 from tqdm.auto import tqdm
 
 from utilities.model_prep import model_prep
 from utilities.composite_models import Generic
 from utilities.avg_meter import AverageMeter
 import utilities.metrics as metrics
-from utilities.load_data import data_loader
+from utilities.load_data import data_loader, CUDAPrefetcher
 from utilities.restore import restore
 from utilities.schedule import schedule
+from utilities.distributed import init_distributed, is_main_process, unwrap
 
 # Paths
-os.chdir('../')
-ROOT_DIR = os.getcwd()
+# resolved from this file instead of changing the working directory, which is not safe under torchrun
+ROOT_DIR = str(Path(__file__).resolve().parent.parent)
 print('Project Root Dir:', ROOT_DIR)
 
 
@@ -50,44 +57,101 @@ def get_arguments():
     parser.add_argument("--current-epoch", type=int, default=0)
     parser.add_argument("--global-counter", type=int, default=0)
     parser.add_argument("--wd", type=float, default=5e-4)
-    return parser.parse_args()
-
-
-def save_checkpoint(args, state, filename):
+    parser.add_argument("--amp", type=str, default='off', choices=['off', 'fp16', 'bf16'],
+                        help='Mixed precision mode, bf16 needs an Ampere or newer GPU')
+    parser.add_argument("--debug", action='store_true', help='Enable autograd anomaly detection (slow)')
+    parser.add_argument("--compile", action='store_true', help='Compile the model with torch.compile (torch>=2.0)')
+    parser.add_argument("--grad-accum", type=int, default=1,
+                        help='Number of batches whose gradients are accumulated before each optimizer step')
+    parser.add_argument("--profile-steps", type=int, default=0,
+                        help='Profile this many training steps (after 3 wait/warmup steps) into a TensorBoard trace')
+    parser.add_argument("--dali", action='store_true', help='Decode the training images on the GPU with NVIDIA DALI')
+    args = parser.parse_args()
+    if args.grad_accum < 1:
+        parser.error('--grad-accum must be at least 1')
+    return args
+
+
+def state_to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().cpu()
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
+@contextlib.contextmanager
+def trace_range(name):
+    # labels the region in the torch.profiler trace and, through NVTX, in Nsight Systems
+    with torch.profiler.record_function(name), torch.cuda.nvtx.range(name):
+        yield
+
+
+def save_checkpoint(args, state, filename, executor):
+    """Writes the checkpoint in the background and returns the corresponding future (None on other ranks)"""
+    if not is_main_process():
+        return None
     save_path = os.path.join(args.snapshot_dir, filename)
-    torch.save(state, save_path)
+    # the host copy is taken now, since training keeps updating the parameters and optimizer state in place
+    return executor.submit(torch.save, state_to_cpu(state), save_path)
 
 
 def get_model(args):
     mdl = model_prep(args.model)
     mdl = Generic(mdl, args.layers.split(), args.version)
     mdl.cuda()
+    # NHWC lets cuDNN pick the Tensor Core convolution kernels
+    mdl.to(memory_format=torch.channels_last)
+    if args.world_size > 1:
+        # only the attention mechanism is trained, the frozen body needs no gradient synchronization
+        mdl.attn_mech = DDP(mdl.attn_mech, device_ids=[args.local_rank], bucket_cap_mb=25,
+                            gradient_as_bucket_view=True)
+    if args.compile:
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError('--compile requires torch 2.0 or newer')
+        # the crop size is fixed, so a static graph is captured and only recompiled for the last, smaller batch
+        mdl = torch.compile(mdl, mode='max-autotune', dynamic=False)
     return mdl
 
 
 def train(args):
+    # input size is fixed, so cuDNN can benchmark once and reuse the fastest convolution algorithms
+    torch.backends.cudnn.benchmark = True
 
-    batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
-    losses_meanMask = AverageMeter()  # Mask energy loss
-    losses_variationMask = AverageMeter()  # Mask variation loss
-    losses_ce = AverageMeter()
+    batch_time = AverageMeter()  # GPU time per batch
+    wall_time = AverageMeter()  # wall time per batch, includes data loading and host overhead
+    # total, cross entropy, mask energy and mask variation losses followed by top1 and top5 accuracy,
+    # stacked so that they are accumulated with a single kernel and copied to the host at once
+    train_stats = AverageMeter()
 
     model = get_model(args)
 
+    # freeze classifier, before splitting the parameters so that only trainable ones reach the optimizer
+    model.requires_grad_(requires_grad=False)
+    model.attn_mech.requires_grad_()
+
     # define optimizer
     # We initially decay the learning rate by one step before the first epoch
-    weights = [weight for name, weight in model.attn_mech.named_parameters() if 'weight' in name]
-    biases = [bias for name, bias in model.attn_mech.named_parameters() if 'bias' in name]
+    weights, biases = [], []
+    for name, param in model.attn_mech.named_parameters():
+        if param.requires_grad:
+            (biases if 'bias' in name else weights).append(param)
 
-    torch.autograd.set_detect_anomaly(True)
+    if args.debug:
+        torch.autograd.set_detect_anomaly(True)
 
+    # foreach applies the update to all the parameters of a group with a few multi-tensor kernels
     # noinspection PyArgumentList
     optimizer = optim.SGD([{'params': weights, 'lr': 1e-7, 'weight_decay': args.wd},
                            {'params': biases, 'lr': 1e-7 * 2}],
-                          momentum=0.9, nesterov=True)
+                          momentum=0.9, nesterov=True, foreach=True)
+
+    # mixed precision, loss scaling is only needed for fp16 since bf16 has the range of fp32
+    amp_dtype = torch.bfloat16 if args.amp == 'bf16' else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=(args.amp == 'fp16'))
+
     if args.restore_from != '':
         args.snapshot_dir = args.restore_from
     else:
@@ -95,24 +159,25 @@ def train(args):
                                          f'{args.model}_{args.version}', '')
     os.makedirs(args.snapshot_dir, exist_ok=True)
     if args.resume == 'True':
-        restore(args, model, optimizer)
+        restore(args, model, optimizer, scaler=scaler)
         if args.current_epoch > args.epoch:
             print('Training Finished')
             return
 
-    # freeze classifier
-    model.requires_grad_(requires_grad=False)
-    model.attn_mech.requires_grad_()
-
     model.train()
 
+    # checkpoints are written by a background thread so that the next epoch starts right away
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    ckpt_future = None
+
     train_loader = data_loader(args)
     steps_per_epoch = len(train_loader)
 
-    with open(os.path.join(args.snapshot_dir, 'train_record.json'), 'a') as fw:
-        config = json.dumps(vars(args), indent=4, separators=(',', ':'))
-        fw.write(config)
-        fw.write('\n\n')
+    if is_main_process():
+        with open(os.path.join(args.snapshot_dir, 'train_record.json'), 'a') as fw:
+            config = json.dumps(vars(args), indent=4, separators=(',', ':'))
+            fw.write(config)
+            fw.write('\n\n')
 
     total_epoch = args.epoch
     global_counter = args.global_counter
@@ -120,105 +185,171 @@ def train(args):
 
     # last epoch sets the correct LR when restarting model
     # First, create loss curve to find correct base_lr and max_lr
-    scheduler = schedule(args, optimizer, steps_per_epoch)
+    # the scheduler advances once per optimizer step, i.e. once every grad_accum batches
+    optimizer_steps_per_epoch = -(-steps_per_epoch // args.grad_accum)
+    scheduler = schedule(args, optimizer, optimizer_steps_per_epoch)
+
+    # GPU time of the sampled batches, CUDA events avoid a host synchronization on every iteration
+    start_evt, end_evt = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
 
-    end = time.perf_counter()
     max_iter = total_epoch * steps_per_epoch
     print('Max iter:', max_iter)
 
+    profiler = None
+    if args.profile_steps > 0 and is_main_process():
+        profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU, torch.profiler.ProfilerActivity.CUDA],
+            schedule=torch.profiler.schedule(wait=1, warmup=2, active=args.profile_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(os.path.join(args.snapshot_dir, 'tb_trace')),
+            record_shapes=True, with_stack=True)
+        profiler.start()
+
     # Epoch loop
     while current_epoch < total_epoch:
-        losses.reset()
-        losses_meanMask.reset()
-        losses_variationMask.reset()  # Mask variation loss
-        losses_ce.reset()  # (1-mask)*img cross entropy loss
-        top1.reset()
-        top5.reset()
+        if isinstance(getattr(train_loader, 'sampler', None), DistributedSampler):
+            # reshuffle the shards every epoch
+            train_loader.sampler.set_epoch(current_epoch)
+        train_stats.reset()
         batch_time.reset()
+        wall_time.reset()
         disp_time = time.perf_counter()
+        disp_idx = -1
         sample_freq = 100
         samples_interval = int(steps_per_epoch / sample_freq)
 
         # Batch loop
-        tq_loader = tqdm(train_loader,
+        # DALI batches are already on the GPU
+        tq_loader = tqdm(train_loader if args.dali else CUDAPrefetcher(train_loader),
                          desc=f'Epoch {current_epoch}',
                          unit='batches',
                          bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [Batch ETA: {remaining}, {rate_fmt}{postfix}]',
-                         miniters=sample_freq)
+                         miniters=sample_freq,
+                         mininterval=1.0,
+                         disable=not is_main_process())
 
         for idx, dat in enumerate(tq_loader):
             imgs, labels = dat
-            imgs, labels = imgs.cuda(), labels.cuda()
-
-            # forward pass
-            logits = model(imgs, labels)
-            masks = model.get_a(labels.long())
-            loss_val, loss_ce_val, loss_meanMask_val, loss_variationMask_val = model.get_loss(logits, labels, masks)
-
-            # gradients that aren't computed are set to None
-            optimizer.zero_grad(set_to_none=True)
-
-            # backwards pass
-            loss_val.backward()
-
-            # optimizer step
-            optimizer.step()
-
-            # lr reduction step
-            scheduler.step()
+            imgs = imgs.contiguous(memory_format=torch.channels_last)
+
+            # every samples_interval batches we time the batch and update the postfix
+            log_step = global_counter % samples_interval == 0
+            if log_step:
+                start_evt.record()
+
+            # the last batch of the epoch always steps so that no gradients carry over
+            is_sync_step = (idx + 1) % args.grad_accum == 0 or idx + 1 == steps_per_epoch
+            # the last group of the epoch may hold fewer batches, each step averages over the batches it covers
+            accum_size = min(args.grad_accum, steps_per_epoch - idx // args.grad_accum * args.grad_accum)
+            # under DDP, the gradients of the accumulated batches are only all-reduced on the sync step
+            sync_ctx = model.attn_mech.no_sync() if isinstance(model.attn_mech, DDP) and not is_sync_step \
+                else contextlib.nullcontext()
+
+            with sync_ctx:
+                # forward pass
+                with trace_range('forward'), torch.autocast(device_type='cuda', dtype=amp_dtype,
+                                                            enabled=(args.amp != 'off')):
+                    logits = model(imgs, labels)
+                    masks = model.get_a(labels.long())
+                    loss_val, loss_ce_val, loss_meanMask_val, loss_variationMask_val = model.get_loss(logits, labels,
+                                                                                                      masks)
+
+                # backwards pass
+                with trace_range('backward'):
+                    scaler.scale(loss_val / accum_size).backward()
+
+            if is_sync_step:
+                with trace_range('optimizer'):
+                    # optimizer step
+                    scaler.step(optimizer)
+                    scaler.update()
+
+                    # gradients that aren't computed are set to None
+                    optimizer.zero_grad(set_to_none=True)
+
+                    # lr reduction step
+                    scheduler.step()
+
+            if log_step:
+                end_evt.record()
 
             logits1 = torch.squeeze(logits)
             prec1_1, prec5_1 = metrics.accuracy(logits1, labels.long(), topk=(1, 5))
-            top1.update(prec1_1[0].item(), imgs.size()[0])
-            top5.update(prec5_1[0].item(), imgs.size()[0])
-
+            # the stats accumulate on the GPU, they are only synchronized when the postfix is updated
             # imgs.size()[0] is simply the batch size
-            losses.update(loss_val.item(), imgs.size()[0])
-            losses_meanMask.update(loss_meanMask_val.item(), imgs.size()[0])
-            losses_variationMask.update(loss_variationMask_val.item(), imgs.size()[0])
-            losses_ce.update(loss_ce_val.item(), imgs.size()[0])
-            batch_time.update(time.perf_counter() - end)
-            end = time.perf_counter()
-
-            # every samples_interval batches we update the postfix
-            if global_counter % samples_interval == 0:
+            train_stats.update(torch.stack([loss_val, loss_ce_val, loss_meanMask_val, loss_variationMask_val,
+                                            prec1_1[0], prec5_1[0]]).detach(), imgs.size()[0])
+
+            if log_step:
+                end_evt.synchronize()
+                batch_time.update(start_evt.elapsed_time(end_evt) / 1000)
+                # the ETA is based on wall time, GPU time alone misses input pipeline stalls
+                now = time.perf_counter()
+                wall_time.update((now - disp_time) / (idx - disp_idx), idx - disp_idx)
+                disp_time, disp_idx = now, idx
                 eta_seconds = ((total_epoch - current_epoch) * steps_per_epoch + (
-                            steps_per_epoch - idx)) * batch_time.avg
+                            steps_per_epoch - idx)) * wall_time.avg
                 eta_str = (datetime.timedelta(seconds=int(eta_seconds)))
-                postfix = {'ETA': eta_str, 'Total Loss': losses.avg, 'CE Loss': losses_ce.avg,
-                           'Mean Loss': losses_meanMask.avg, 'Var Loss': losses_variationMask.avg,
-                           'Top1 Acc': top1.avg, 'Top5 Acc': top5.avg}
-                tq_loader.set_postfix(postfix)
-
-                losses.reset()
-                losses_meanMask.reset()
-                losses_variationMask.reset()
-                losses_ce.reset()
-                top1.reset()
-                top5.reset()
+                loss_avg, loss_ce_avg, loss_meanMask_avg, loss_variationMask_avg, top1_avg, top5_avg = \
+                    train_stats.flush()
+                postfix = {'ETA': eta_str, 'GPU Time': batch_time.avg, 'Total Loss': loss_avg, 'CE Loss': loss_ce_avg,
+                           'Mean Loss': loss_meanMask_avg, 'Var Loss': loss_variationMask_avg,
+                           'Top1 Acc': top1_avg, 'Top5 Acc': top5_avg}
+                # the postfix is drawn with the next regular refresh instead of forcing a terminal write
+                tq_loader.set_postfix(postfix, refresh=False)
+
+                train_stats.reset()
 
             global_counter += 1
 
+            if profiler is not None:
+                profiler.step()
+                # wait, warmup and active steps are done, the trace has been written
+                if global_counter - args.global_counter >= args.profile_steps + 3:
+                    profiler.stop()
+                    profiler = None
+
         current_epoch += 1
         # first epoch: 1, during training it is current_epoch == 0, saved as epoch_1 ...
         # last epoch: 8, during training it is current_epoch ==7, saved as epoch_8
-        save_checkpoint(args,
-                        {
-                            'epoch': current_epoch,
-                            'global_counter': global_counter,
-                            'state_dict': model.attn_mech.state_dict(),
-                            'optimizer': optimizer.state_dict()
-                        },
-                        filename=f'epoch_{current_epoch}.pt')
+        if ckpt_future is not None:
+            # surface any error of the previous save
+            ckpt_future.result()
+        ckpt_future = save_checkpoint(args,
+                                      {
+                                          'epoch': current_epoch,
+                                          'global_counter': global_counter,
+                                          'state_dict': unwrap(model.attn_mech).state_dict(),
+                                          'optimizer': optimizer.state_dict(),
+                                          'scaler': scaler.state_dict()
+                                      },
+                                      filename=f'epoch_{current_epoch}.pt',
+                                      executor=ckpt_executor)
+
+    if profiler is not None:
+        profiler.stop()
+    ckpt_executor.shutdown(wait=True)
+    if ckpt_future is not None:
+        ckpt_future.result()
+
 
 def main():
     cmd_args = get_arguments()
+    init_distributed(cmd_args)
     cmd_args.train_list = os.path.join(ROOT_DIR, 'datalist', 'ILSVRC', cmd_args.train_list)
-    print('Running parameters:\n')
-    print(json.dumps(vars(cmd_args), indent=4))
-    if not os.path.exists(cmd_args.snapshot_dir):
-        os.mkdir(cmd_args.snapshot_dir)
+    # relative paths are given with respect to the project root, as in pc_info.sh
+    cmd_args.img_dir = os.path.join(ROOT_DIR, cmd_args.img_dir)
+    cmd_args.snapshot_dir = os.path.join(ROOT_DIR, cmd_args.snapshot_dir)
+    if cmd_args.restore_from != '':
+        cmd_args.restore_from = os.path.join(ROOT_DIR, cmd_args.restore_from)
+    # the effective batch size grows with the number of processes
+    cmd_args.max_lr *= cmd_args.world_size
+    if is_main_process():
+        print('Running parameters:\n')
+        print(json.dumps(vars(cmd_args), indent=4))
+    os.makedirs(cmd_args.snapshot_dir, exist_ok=True)
     train(cmd_args)
+    if dist.is_initialized():
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
@@ -1,15 +1,19 @@
+import torch
+
+
 class AverageMeter(object):
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value
+
+    Values may be (stacked) CUDA tensors, they are then accumulated on the device and only
+    copied to the host by flush()"""
     def __init__(self):
         self.val = None
-        self.avg = None
         self.sum = None
         self.count = None
         self.reset()
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
@@ -17,4 +21,12 @@ class AverageMeter(object):
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0
+
+    def flush(self):
+        """Returns the average as python number(s), synchronizing with the device if needed"""
+        avg = self.avg
+        return avg.tolist() if torch.is_tensor(avg) else avg
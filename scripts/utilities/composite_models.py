@@ -10,12 +10,18 @@ from torchvision import transforms
 from torchvision.models.feature_extraction import create_feature_extractor, get_graph_node_names
 
 
+def _resize_to(inp, size):
+    # feature maps already at the target size are passed through instead of being copied by a no-op resize
+    if inp.shape[-2:] == size:
+        return inp
+    return F.interpolate(inp, size=size, mode='bilinear', align_corners=False)
+
+
 class AttentionTAME(nn.Module):
     def __init__(self, ft_size):
         super(AttentionTAME, self).__init__()
         feat_height = ft_size[0][2] if ft_size[0][2] <= 56 else 56
-        self.interpolate = lambda inp: F.interpolate(inp, size=(feat_height, feat_height),
-                                                     mode='bilinear', align_corners=False)
+        self.interpolate = lambda inp: _resize_to(inp, (feat_height, feat_height))
         in_channels_list = [o[1] for o in ft_size]
         # noinspection PyTypeChecker
         self.convs = nn.ModuleList([nn.Conv2d(in_channels=in_channels, out_channels=in_channels, kernel_size=1,
@@ -58,8 +64,7 @@ class AttentionV3d2dd1(nn.Module):
     def __init__(self, ft_size):
         super(AttentionV3d2dd1, self).__init__()
         feat_height = ft_size[0][2] if ft_size[0][2] <= 56 else 56
-        self.interpolate = lambda inp: F.interpolate(inp, size=(feat_height, feat_height),
-                                                     mode='bilinear', align_corners=False)
+        self.interpolate = lambda inp: _resize_to(inp, (feat_height, feat_height))
         in_channels_list = [o[1] for o in ft_size]
         # noinspection PyTypeChecker
         self.convs = nn.ModuleList([nn.Conv2d(in_channels=in_channels, out_channels=1000, kernel_size=1, padding=0,
@@ -93,8 +98,7 @@ class AttentionV3d2(nn.Module):
     def __init__(self, ft_size):
         super(AttentionV3d2, self).__init__()
         feat_height = ft_size[0][2] if ft_size[0][2] <= 56 else 56
-        self.interpolate = lambda inp: F.interpolate(inp, size=(feat_height, feat_height),
-                                                     mode='bilinear', align_corners=False)
+        self.interpolate = lambda inp: _resize_to(inp, (feat_height, feat_height))
         in_channels_list = [o[1] for o in ft_size]
         # noinspection PyTypeChecker
         self.convs = nn.ModuleList([nn.Conv2d(in_channels=in_channels, out_channels=in_channels, kernel_size=1, padding=0,
@@ -127,8 +131,7 @@ class AttentionV5d1(nn.Module):
     def __init__(self, ft_size):
         super(AttentionV5d1, self).__init__()
         feat_height = ft_size[0][2] if ft_size[0][2] <= 56 else 56
-        self.interpolate = lambda inp: F.interpolate(inp, size=(feat_height, feat_height),
-                                                     mode='bilinear', align_corners=False)
+        self.interpolate = lambda inp: _resize_to(inp, (feat_height, feat_height))
         in_channels_list = [o[1] for o in ft_size]
         # noinspection PyTypeChecker
         self.convs = nn.ModuleList([nn.Conv2d(in_channels=in_channels, out_channels=in_channels, kernel_size=1,
@@ -225,7 +228,13 @@ class Generic(nn.Module):
     def forward(self, x, label=None):
         x_norm = Generic.normalization(x)
 
-        features = self.body(x_norm)
+        if self.training:
+            # the body is frozen, so no autograd graph is needed for the feature maps, gradients only flow
+            # through the attention mechanism and the masked forward pass of train_policy
+            with torch.no_grad():
+                features = self.body(x_norm)
+        else:
+            features = self.body(x_norm)
         x_norm = features.pop(self.output)
 
         # features now only has the feature maps since we popped the output in case we are in eval mode
@@ -305,7 +314,7 @@ class Arrangement(nn.Module):
 
     def train_policy1(self, masks, labels, inp):
         B, C, H, W = masks.size()
-        indexes = labels.expand(H, W, 1, B).permute(*torch.arange(masks.ndim - 1, -1, -1))
+        indexes = labels.expand(H, W, 1, B).permute(*range(masks.ndim - 1, -1, -1))
         masks = torch.gather(masks, 1, indexes)  # select masks
         masks = F.interpolate(masks, size=(224, 224), mode='bilinear', align_corners=False)
         x_masked = masks * inp
@@ -0,0 +1,26 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(args):
+    """Sets up the process group when launched with torchrun, otherwise falls back to a single GPU"""
+    args.rank = int(os.environ.get('RANK', 0))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if args.world_size > 1:
+        dist.init_process_group(backend='nccl')
+    torch.cuda.set_device(args.local_rank)
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def unwrap(module):
+    # checkpoints store the bare module so that they stay loadable without DDP
+    if isinstance(module, DistributedDataParallel):
+        return module.module
+    return module
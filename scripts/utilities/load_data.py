@@ -1,10 +1,14 @@
 # checked, should be working correctly, there are differences arising from the use of torchvision.transforms
 import os
+import random
 from typing import Callable, Dict, List, Optional, Tuple
 
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
+import torch
+import torch.distributed as dist
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 
 def data_loader(args, train=True):
@@ -12,6 +16,10 @@ def data_loader(args, train=True):
     input_size = int(args.input_size)
     crop_size = int(args.crop_size)
 
+    if train and getattr(args, 'dali', False):
+        return DALILoader(args.img_dir, args.train_list, args.batch_size, input_size, crop_size,
+                          num_threads=max(args.num_workers, 1))
+
     if train:
         tsfm_train = transforms.Compose([
             transforms.Resize(input_size),
@@ -21,8 +29,12 @@ def data_loader(args, train=True):
         ])
         img_train = MyDataset(args.img_dir, args.train_list,
                               transform=tsfm_train)
-        train_loader = DataLoader(img_train, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
-                                  pin_memory=True)
+        # under torchrun every process gets its own shard of the training list
+        sampler = DistributedSampler(img_train, shuffle=True) if dist.is_initialized() else None
+        # keep the workers alive between epochs and a few batches ahead of the GPU
+        worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4} if args.num_workers > 0 else {}
+        train_loader = DataLoader(img_train, batch_size=args.batch_size, shuffle=(sampler is None), sampler=sampler,
+                                  num_workers=args.num_workers, pin_memory=True, **worker_kwargs)
         return train_loader
 
     else:
@@ -41,6 +53,94 @@ def data_loader(args, train=True):
         return val_loader
 
 
+class CUDAPrefetcher:
+    """Wraps a DataLoader with pinned memory and copies the next batch to the GPU on a side stream,
+    so that the host to device transfer overlaps with the computation on the current batch"""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        pending = None
+        for batch in self.loader:
+            with torch.cuda.stream(self.stream):
+                batch = [tensor.cuda(non_blocking=True) for tensor in batch]
+                ready = torch.cuda.Event()
+                ready.record(self.stream)
+            if pending is not None:
+                yield self._wait(*pending)
+            pending = batch, ready
+        if pending is not None:
+            yield self._wait(*pending)
+
+    @staticmethod
+    def _wait(batch, ready):
+        stream = torch.cuda.current_stream()
+        stream.wait_event(ready)
+        # the memory was allocated on the side stream, it must not be reused before the main stream is done with it
+        for tensor in batch:
+            tensor.record_stream(stream)
+        return batch
+
+
+class DALILoader:
+    """Training loader that decodes and augments the JPEGs on the GPU with NVIDIA DALI, requires nvidia-dali.
+    Applies the same Resize, RandomCrop, RandomHorizontalFlip and ToTensor steps as the torchvision pipeline
+    and yields (imgs, labels) batches that are already on the current GPU"""
+
+    def __init__(self, img_dir, img_list, batch_size, input_size, crop_size, num_threads=4):
+        try:
+            from nvidia.dali import fn, pipeline_def, types
+            from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+        except ImportError:
+            raise ImportError('The DALI loader requires nvidia-dali, see '
+                              'https://docs.nvidia.com/deeplearning/dali/user-guide/docs/installation.html')
+
+        samples = read_labeled_image_list(img_dir, img_list)
+        # the training lists are sorted by class, so the first epoch needs a global permutation as well;
+        # the fixed seed gives every rank the same order, so that the shards stay disjoint
+        random.Random(0).shuffle(samples)
+        files, labels = zip(*samples)
+        # under torchrun every process reads its own shard of the training list
+        shard_id = dist.get_rank() if dist.is_initialized() else 0
+        num_shards = dist.get_world_size() if dist.is_initialized() else 1
+
+        @pipeline_def
+        def pipeline():
+            # shuffle_after_epoch reshuffles the whole list consistently across shards,
+            # random_shuffle would only shuffle within the prefetch buffer
+            jpegs, targets = fn.readers.file(files=list(files), labels=list(labels), shuffle_after_epoch=True,
+                                             shard_id=shard_id, num_shards=num_shards, pad_last_batch=True,
+                                             name='Reader')
+            images = fn.decoders.image(jpegs, device='mixed', output_type=types.RGB)
+            images = fn.resize(images, resize_shorter=input_size)
+            images = fn.crop_mirror_normalize(images, dtype=types.FLOAT, output_layout='CHW',
+                                              crop=(crop_size, crop_size),
+                                              crop_pos_x=fn.random.uniform(range=(0., 1.)),
+                                              crop_pos_y=fn.random.uniform(range=(0., 1.)),
+                                              mean=[0., 0., 0.], std=[255., 255., 255.],
+                                              mirror=fn.random.coin_flip())
+            return images, targets.gpu()
+
+        pipe = pipeline(batch_size=batch_size, num_threads=num_threads, device_id=torch.cuda.current_device())
+        pipe.build()
+        # padded shards and dropping the last partial batch give every rank the same number of iterations,
+        # otherwise DDP waits forever on the all-reduce of the rank with an extra batch
+        self.iterator = DALIGenericIterator(pipe, ['imgs', 'labels'], reader_name='Reader',
+                                            last_batch_policy=LastBatchPolicy.DROP, auto_reset=True)
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __iter__(self):
+        for batch in self.iterator:
+            yield batch[0]['imgs'], batch[0]['labels'].squeeze(-1).long()
+
+
 class MyDataset(datasets.ImageFolder):
 
     def __init__(self, img_dir, img_list, transform=None):
@@ -2,8 +2,10 @@ import os
 
 import torch
 
+from .distributed import unwrap
 
-def restore(args, model, optimizer=None, istrain=True):
+
+def restore(args, model, optimizer=None, istrain=True, scaler=None):
     if os.path.isfile(args.restore_from) and ('.pt' in args.restore_from):
         snapshot = args.restore_from
     else:
@@ -24,13 +26,16 @@ def restore(args, model, optimizer=None, istrain=True):
 
     if os.path.isfile(snapshot):
         print("=> loading checkpoint '{}'".format(snapshot))
-        checkpoint = torch.load(snapshot)
+        checkpoint = torch.load(snapshot, map_location='cpu')
         try:
             if istrain:
                 args.current_epoch = checkpoint['epoch'] + 1
                 args.global_counter = checkpoint['global_counter'] + 1
                 optimizer.load_state_dict(checkpoint['optimizer'])
-            model.attn_mech.load_state_dict(checkpoint['state_dict'])
+                # checkpoints written without fp16 have no (or an empty) loss scaler state
+                if scaler is not None and checkpoint.get('scaler'):
+                    scaler.load_state_dict(checkpoint['scaler'])
+            unwrap(model.attn_mech).load_state_dict(checkpoint['state_dict'])
             print("=> loaded checkpoint '{}' (epoch {})"
                   .format(snapshot, checkpoint['epoch']))
         except KeyError: